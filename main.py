@@ -1,16 +1,25 @@
 import os
 import json
 import time
-from datetime import datetime, timezone
+import queue
+import random
+import itertools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING
 
 import gspread
-from alpaca_trade_api.rest import REST, TimeFrame  # TimeFrame not needed, but keeps import handy
+
+if TYPE_CHECKING:
+    from alpaca_trade_api.rest import REST   # imported lazily in make_alpaca (pulls in pandas/numpy)
 
 
 # =========================
 # Config (env or defaults)
 # =========================
 SHEET_NAME    = os.getenv("SHEET_NAME", "Trading Log")
+SHEET_ID      = os.getenv("SHEET_ID", "")   # optional; preferred over SHEET_NAME when set
 SCREENER_TAB  = os.getenv("SCREENER_TAB", "screener")
 LOG_TAB       = os.getenv("LOG_TAB", "log")
 
@@ -21,19 +30,34 @@ APCA_API_BASE_URL  = os.getenv("APCA_API_BASE_URL", "https://api.alpaca.markets"
 # Buy 5% of available buying power per symbol
 PERCENT_PER_TRADE       = float(os.getenv("PERCENT_PER_TRADE", "5.0"))   # percent
 MIN_ORDER_NOTIONAL      = float(os.getenv("MIN_ORDER_NOTIONAL", "1.00"))  # floor
-SLEEP_BETWEEN_ORDERS_SEC= float(os.getenv("SLEEP_BETWEEN_ORDERS_SEC", "0.5"))
+MAX_ORDERS_PER_MIN      = float(os.getenv("MAX_ORDERS_PER_MIN", "200"))   # Alpaca REST cap
+RATE_LIMIT_LOW_WATER    = int(os.getenv("RATE_LIMIT_LOW_WATER", "5"))      # back off below this
+ORDER_WORKERS           = max(1, int(os.getenv("ORDER_WORKERS", "8")))
+ORDER_MAX_ATTEMPTS      = max(1, int(os.getenv("ORDER_MAX_ATTEMPTS", "4")))  # per Alpaca call, on 429/5xx
+ORDER_RETRY_BASE_SEC    = float(os.getenv("ORDER_RETRY_BASE_SEC", "0.5"))
+ORDER_RETRY_MAX_SEC     = float(os.getenv("ORDER_RETRY_MAX_SEC", "8.0"))
+LOG_FLUSH_SEC           = float(os.getenv("LOG_FLUSH_SEC", "2.0"))   # max wait to fill a batch
 EXTENDED_HOURS          = os.getenv("EXTENDED_HOURS", "false").lower() in ("1", "true", "yes")
+ACCOUNT_RESYNC_EVERY    = int(os.getenv("ACCOUNT_RESYNC_EVERY", "20"))    # symbols; 0 = never
 
 # Sheet layout anchors
 LOG_HEADERS     = ["Timestamp","Action","Symbol","NotionalUSD","Qty","OrderID","Status","Note"]
 LOG_TABLE_RANGE = "A1:H1"
+LOG_APPEND_MAX_ROWS = 10000   # keep each values.append request well under Google's payload limit
+
+# Run-to-run cache of the resolved Ticker column, keyed by sheet id + tabs
+CACHE_PATH      = os.getenv("BOT_CACHE_PATH", "/tmp/bot_cache.json")
+
+# Process-wide suffix for client_order_id (next() on itertools.count is atomic under the GIL)
+_coid_counter = itertools.count()
 
 
 # =========================
 # Helpers
 # =========================
 def now_iso_utc():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    t = time.gmtime()
+    return "%04d-%02d-%02dT%02d:%02d:%02dZ" % (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
 
 
 def get_google_client():
@@ -44,8 +68,33 @@ def get_google_client():
     return gspread.service_account_from_dict(creds)
 
 
-def _get_ws(gc, sheet_name, tab):
-    sh = gc.open(sheet_name)
+def open_sheet(gc):
+    """Opens the spreadsheet once; by key when SHEET_ID is set (skips the Drive name lookup)."""
+    if SHEET_ID:
+        return gc.open_by_key(SHEET_ID)
+    return gc.open(SHEET_NAME)
+
+
+def load_cache():
+    """Local run-to-run cache (resolved columns); empty if missing or unreadable."""
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    try:
+        tmp = CACHE_PATH + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not write cache {CACHE_PATH}: {e}")
+
+
+def _get_ws(sh, tab):
     try:
         return sh.worksheet(tab)
     except gspread.WorksheetNotFound:
@@ -53,20 +102,24 @@ def _get_ws(gc, sheet_name, tab):
 
 
 def ensure_log(ws):
-    """Ensure header is exactly in A1:H1 and frozen; prevents offset drift."""
+    """
+    Ensure header is exactly in A1:H1; prevents offset drift.
+    Row 1 is frozen only when the header is (re)written, not on every run.
+    """
     vals = ws.get_values("A1:H1")
     if not vals or vals[0] != LOG_HEADERS:
         ws.update("A1:H1", [LOG_HEADERS])
-    try:
-        ws.freeze(rows=1)
-    except Exception:
-        pass
+        try:
+            ws.freeze(rows=1)
+        except Exception:
+            pass
 
 
 def append_logs(ws, rows):
     """
     Append logs anchored to A1:H1, forcing exactly 8 columns per row.
     This avoids Sheets creating a separate 'table' off to the right.
+    One values.append call per batch; only splits past LOG_APPEND_MAX_ROWS.
     """
     if not rows:
         return
@@ -77,75 +130,251 @@ def append_logs(ws, rows):
         elif len(r) > 8:
             r = r[:8]
         fixed.append(r)
-    try:
-        # Anchor appends to our table
-        for i in range(0, len(fixed), 100):
-            ws.append_rows(
-                fixed[i:i+100],
-                value_input_option="RAW",     # avoid locale/date auto-parsing
-                table_range=LOG_TABLE_RANGE   # <<< anchor prevents offset
-            )
-    except TypeError:
-        # Fallback for older gspread without table_range support
-        start_row = len(ws.get_all_values()) + 1
-        end_row = start_row + len(fixed) - 1
-        ws.update(f"A{start_row}:H{end_row}", fixed, value_input_option="RAW")
-
-
-def read_screener_tickers(ws):
-    """
-    Reads the screener tab and returns a list of tickers.
-    Assumes a header row containing a column named 'Ticker'; falls back to first col.
-    """
-    values = ws.get_all_values()
-    if not values:
-        return []
+    for i in range(0, len(fixed), LOG_APPEND_MAX_ROWS):
+        ws.append_rows(
+            fixed[i:i+LOG_APPEND_MAX_ROWS],
+            value_input_option="RAW",           # avoid locale/date auto-parsing
+            insert_data_option="INSERT_ROWS",   # grow the grid instead of overwriting
+            table_range=LOG_TABLE_RANGE         # <<< anchor prevents offset
+        )
+
 
-    header = [h.strip() for h in values[0]]
+def start_log_writer(ws):
+    """
+    Starts a background thread that drains log rows from the returned queue and
+    appends them while orders are still being submitted, one call per batch of
+    whatever arrived within LOG_FLUSH_SEC.
+    Put None to stop, then join() the queue to wait for the drain.
+    """
+    log_q = queue.Queue()
+
+    def _run():
+        while True:
+            items = [log_q.get()]
+            deadline = time.monotonic() + LOG_FLUSH_SEC   # linger so writes stay batched
+            while items[-1] is not None:
+                try:
+                    items.append(log_q.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            rows = [r for r in items if r is not None]
+            try:
+                append_logs(ws, rows)
+            except Exception as e:
+                print(f"❌ Log write failed ({len(rows)} rows): {type(e).__name__}: {e}")
+            finally:
+                for _ in items:
+                    log_q.task_done()
+            if len(rows) < len(items):
+                return
+
+    threading.Thread(target=_run, name="log-writer", daemon=True).start()
+    return log_q
+
+
+def ticker_column(ws, cached_col=None, cached_header=None):
+    """
+    Returns (column letter, header text) for the screener's 'Ticker' column;
+    falls back to A. A cached letter is re-validated with a single-cell read
+    that must still show the header text seen when it was resolved.
+    Returns (None, None) if the header row is empty.
+    """
+    if cached_col and cached_header is not None:
+        if (ws.acell(f"{cached_col}1").value or "").strip() == cached_header:
+            return cached_col, cached_header
+
+    header = [h.strip() for h in ws.row_values(1)]
+    if not header:
+        return None, None
     try:
         idx = header.index("Ticker")
     except ValueError:
         idx = 0
+    return gspread.utils.rowcol_to_a1(1, idx + 1)[:-1], header[idx]
+
+
+def read_screener_tickers(ws, letter):
+    """
+    Reads the screener's ticker column (by letter) and returns a list of tickers.
+    Only that column is fetched, not the whole tab.
+    """
+    if not letter:
+        return []
+    resp = ws.spreadsheet.values_get(
+        gspread.utils.absolute_range_name(ws.title, f"{letter}2:{letter}"),
+        params={"majorDimension": "COLUMNS", "valueRenderOption": "UNFORMATTED_VALUE"},
+    )
+    column = (resp.get("values") or [[]])[0]
+
+    tickers = (str(v).strip().upper() for v in column)
+    # Preserve order while de-duping (dict keeps insertion order)
+    return list(dict.fromkeys(t for t in tickers if t))
+
 
-    tickers = []
-    for row in values[1:]:
-        if idx < len(row):
-            t = row[idx].strip().upper()
-            if t:
-                tickers.append(t)
+class RateLimiter:
+    """
+    Thread-safe spacing of calls to at most `per_min` per minute.
+    Also pauses everyone until the reset time once Alpaca's
+    X-RateLimit-Remaining header drops below RATE_LIMIT_LOW_WATER.
+    """
 
-    # Preserve order while de-duping
-    seen = set()
-    ordered = []
-    for t in tickers:
-        if t not in seen:
-            seen.add(t)
-            ordered.append(t)
-    return ordered
+    def __init__(self, per_min: float):
+        self.interval = 60.0 / per_min if per_min > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._pause_until = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._pause_until)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def observe(self, resp, *args, **kwargs):
+        """requests response hook: back off when the remaining quota runs low."""
+        try:
+            remaining = int(resp.headers.get("X-RateLimit-Remaining", ""))
+        except ValueError:
+            return
+        if remaining >= RATE_LIMIT_LOW_WATER:
+            return
+        try:
+            delay = float(resp.headers.get("X-RateLimit-Reset", "")) - time.time()
+        except ValueError:
+            delay = 1.0
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.monotonic() + max(0.0, delay))
 
 
 def make_alpaca():
     if not (ALPACA_API_KEY and ALPACA_SECRET_KEY):
         raise RuntimeError("Missing ALPACA_API_KEY / ALPACA_SECRET_KEY.")
-    return REST(key_id=ALPACA_API_KEY, secret_key=ALPACA_SECRET_KEY, base_url=APCA_API_BASE_URL)
+    from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+    from alpaca_trade_api.rest import REST
+
+    api = REST(key_id=ALPACA_API_KEY, secret_key=ALPACA_SECRET_KEY, base_url=APCA_API_BASE_URL)
+    # Every call goes through call_with_retry; the SDK's fixed-wait retry would stack on top
+    api._retry = 0
+    # Never shrink below requests' default pool; grow it when ORDER_WORKERS exceeds it so
+    # every worker keeps a warm keep-alive connection instead of discarding overflow sockets
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(ORDER_WORKERS, DEFAULT_POOLSIZE))
+    api._session.mount("https://", adapter)
+    return api
 
 
-def place_buy_notional(api: REST, symbol: str, notional: float, extended: bool):
+def _http_status(e):
+    """HTTP status carried by an Alpaca APIError or requests.HTTPError, else None."""
+    status = getattr(e, "status_code", None)                                   # APIError
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)   # requests.HTTPError
+    return status
+
+
+def _retryable_status(e):
+    """HTTP status of a transient Alpaca error (429 or 5xx), else None."""
+    status = _http_status(e)
+    if status == 429 or (isinstance(status, int) and status >= 500):
+        return status
+    return None
+
+
+def call_with_retry(fn, label, limiter=None):
+    """
+    Calls fn(), retrying 429/5xx up to ORDER_MAX_ATTEMPTS times with jittered
+    exponential backoff; on 429 the limiter also holds every worker until
+    X-RateLimit-Reset. Used for every Alpaca call, since the SDK's own retry is off.
+    """
+    for attempt in range(ORDER_MAX_ATTEMPTS):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return fn()
+        except Exception as e:
+            status = _retryable_status(e)
+            if status is None or attempt + 1 >= ORDER_MAX_ATTEMPTS:
+                raise
+            delay = min(ORDER_RETRY_MAX_SEC, ORDER_RETRY_BASE_SEC * 2 ** attempt)
+            delay *= random.uniform(0.5, 1.0)
+            print(f"🔁 {label} HTTP {status}; retry {attempt + 1}/{ORDER_MAX_ATTEMPTS - 1} in {delay:.2f}s")
+            time.sleep(delay)
+
+
+def get_buying_power(api: "REST", limiter=None) -> float:
+    """Current buying power; falls back to cash if buying_power is not present."""
+    acct = call_with_retry(api.get_account, "account", limiter)
+    try:
+        return float(acct.buying_power)
+    except Exception:
+        return float(acct.cash)
+
+
+def place_buy_notional(api: "REST", symbol: str, notional: float, extended: bool, limiter=None):
     """
     Places a market buy with notional dollars. Returns the order object.
-    Adds an idempotent client_order_id so retries won't double-buy.
-    """
-    client_order_id = f"buy-{symbol}-{int(time.time()*1000)}"
-    order = api.submit_order(
-        symbol=symbol,
-        side="buy",
-        type="market",
-        time_in_force="day",
-        notional=round(notional, 2),
-        extended_hours=extended,
-        client_order_id=client_order_id,
-    )
-    return order
+    Adds an idempotent client_order_id so retries won't double-buy; the counter
+    keeps ids unique even when worker threads submit in the same nanosecond tick.
+    Transient failures are retried via call_with_retry.
+    """
+    client_order_id = f"buy-{symbol}-{time.time_ns()}-{next(_coid_counter)}"
+    attempts = []
+
+    def _submit():
+        attempts.append(client_order_id)
+        return api.submit_order(
+            symbol=symbol,
+            side="buy",
+            type="market",
+            time_in_force="day",
+            notional=round(notional, 2),
+            extended_hours=extended,
+            client_order_id=client_order_id,
+        )
+
+    try:
+        return call_with_retry(_submit, symbol, limiter)
+    except Exception as e:
+        # A 5xx can come back for an order Alpaca did accept; the retry then trips
+        # the duplicate client_order_id check (422). Return the live order instead.
+        if len(attempts) > 1 and _http_status(e) == 422:
+            try:
+                return call_with_retry(
+                    lambda: api.get_order_by_client_order_id(client_order_id), symbol, limiter)
+            except Exception:
+                pass
+        raise
+
+
+def submit_buys(api: "REST", tasks, limiter, log_q):
+    """
+    Submits (symbol, notional) buys concurrently on ORDER_WORKERS threads.
+    Puts a log row on log_q as each order completes.
+    Returns the total notional of orders that failed, i.e. buying power not spent.
+    """
+    failed_notional = 0.0
+    if not tasks:
+        return failed_notional
+    with ThreadPoolExecutor(max_workers=ORDER_WORKERS) as ex:
+        futures = {ex.submit(place_buy_notional, api, s, n, EXTENDED_HOURS, limiter): (s, n) for s, n in tasks}
+        for fut in as_completed(futures):
+            symbol, notional = futures[fut]
+            try:
+                order = fut.result()
+                qty    = getattr(order, "qty", "") or ""   # may be empty pre-fill for notional
+                status = getattr(order, "status", "submitted")
+                oid    = getattr(order, "id", "")
+
+                print(f"✅ Submitted BUY {symbol} ${notional:.2f} (order {oid}, status {status})")
+
+                log_q.put([now_iso_utc(), "BUY", symbol, f"{notional:.2f}", str(qty), oid, status, ""])
+
+            except Exception as e:
+                msg = f"{type(e).__name__}: {e}"
+                print(f"❌ {symbol} {msg}")
+                log_q.put([now_iso_utc(), "BUY-ERROR", symbol, "", "", "", "ERROR", msg])
+                failed_notional += notional
+    return failed_notional
 
 
 # =========================
@@ -156,54 +385,73 @@ def main():
 
     # Connect
     gc  = get_google_client()
-    api = make_alpaca()
 
     # Sheets
-    screener_ws = _get_ws(gc, SHEET_NAME, SCREENER_TAB)
-    log_ws      = _get_ws(gc, SHEET_NAME, LOG_TAB); ensure_log(log_ws)
+    sh          = open_sheet(gc)
+    screener_ws = _get_ws(sh, SCREENER_TAB)
+    log_ws      = _get_ws(sh, LOG_TAB); ensure_log(log_ws)
+
+    cache     = load_cache()
+    cache_key = f"{sh.id}:{SCREENER_TAB}:{LOG_TAB}"
+    cached    = cache.get(cache_key, {})
 
     # Read symbols to buy
-    symbols = read_screener_tickers(screener_ws)
+    ticker_col, ticker_header = ticker_column(
+        screener_ws, cached.get("ticker_col"), cached.get("ticker_header"))
+    symbols = read_screener_tickers(screener_ws, ticker_col)
+    cache[cache_key] = {"ticker_col": ticker_col, "ticker_header": ticker_header}
+    save_cache(cache)
     if not symbols:
         print("ℹ️ Screener has no tickers to buy. Exiting.")
         return
 
-    # Loop & buy 5% of CURRENT buying power for each symbol
-    logs = []
-    for i, symbol in enumerate(symbols, 1):
-        try:
-            # Refresh account each time so we never overspend
-            acct = api.get_account()
-            # Use buying_power; fall back to cash if not present
-            try:
-                buying_power = float(acct.buying_power)
-            except Exception:
-                buying_power = float(acct.cash)
-
-            notional = buying_power * (PERCENT_PER_TRADE / 100.0)
-            if notional < MIN_ORDER_NOTIONAL:
-                note = f"Notional {notional:.2f} < MIN_ORDER_NOTIONAL {MIN_ORDER_NOTIONAL:.2f}"
-                print(f"⚠️ {symbol} {note}")
-                logs.append([now_iso_utc(), "BUY-SKIP", symbol, f"{notional:.2f}", "", "", "SKIPPED", note])
-                continue
-
-            order = place_buy_notional(api, symbol, notional, EXTENDED_HOURS)
-            qty    = getattr(order, "qty", "") or ""   # may be empty pre-fill for notional
-            status = getattr(order, "status", "submitted")
-            oid    = getattr(order, "id", "")
-
-            print(f"✅ Submitted BUY {symbol} ${notional:.2f} (order {oid}, status {status})")
-
-            logs.append([now_iso_utc(), "BUY", symbol, f"{notional:.2f}", str(qty), oid, status, ""])
-            time.sleep(SLEEP_BETWEEN_ORDERS_SEC)
+    # Alpaca SDK is only imported once there is something to buy
+    api = make_alpaca()
 
-        except Exception as e:
-            msg = f"{type(e).__name__}: {e}"
-            print(f"❌ {symbol} {msg}")
-            logs.append([now_iso_utc(), "BUY-ERROR", symbol, "", "", "", "ERROR", msg])
+    # Rate-limit Alpaca calls (order submits and account reads); watch the rate-limit headers
+    limiter = RateLimiter(MAX_ORDERS_PER_MIN)
+    api._session.hooks["response"].append(limiter.observe)
 
-    # Write logs (anchored)
-    append_logs(log_ws, logs)
+    # Buy 5% of REMAINING buying power for each symbol, in waves of ACCOUNT_RESYNC_EVERY
+    # symbols; buying power is re-read before each wave to correct drift (if that read
+    # fails, the locally tracked value carries over)
+    wave = ACCOUNT_RESYNC_EVERY if ACCOUNT_RESYNC_EVERY > 0 else len(symbols)
+    log_q = start_log_writer(log_ws)
+    try:
+        remaining_bp = None
+        for start in range(0, len(symbols), wave):
+            batch = symbols[start:start + wave]
+            try:
+                remaining_bp = get_buying_power(api, limiter)
+            except Exception as e:
+                msg = f"{type(e).__name__}: {e}"
+                if remaining_bp is None:
+                    # Nothing to fall back on yet: log this wave as errors and try the next
+                    print(f"❌ Account read failed; skipping {len(batch)} symbols: {msg}")
+                    for symbol in batch:
+                        log_q.put([now_iso_utc(), "BUY-ERROR", symbol, "", "", "", "ERROR", msg])
+                    continue
+                print(f"⚠️ Account re-sync failed, using tracked buying power {remaining_bp:.2f}: {msg}")
+
+            tasks = []
+            for symbol in batch:
+                notional = remaining_bp * (PERCENT_PER_TRADE / 100.0)
+                if notional < MIN_ORDER_NOTIONAL:
+                    note = f"Notional {notional:.2f} < MIN_ORDER_NOTIONAL {MIN_ORDER_NOTIONAL:.2f}"
+                    print(f"⚠️ {symbol} {note}")
+                    log_q.put([now_iso_utc(), "BUY-SKIP", symbol, f"{notional:.2f}", "", "", "SKIPPED", note])
+                    continue
+                remaining_bp -= notional   # reserved at planning time; orders in a run don't settle
+                tasks.append((symbol, notional))
+
+            # Release what failed orders reserved, so the tracked value stays accurate
+            # as the fallback when the next wave's re-sync fails
+            remaining_bp += submit_buys(api, tasks, limiter, log_q)
+    finally:
+        # Always drain the background log writer, so rows for orders already
+        # submitted reach the sheet even if the loop above raised
+        log_q.put(None)
+        log_q.join()
     print("✅ Buy cycle complete")
 
 
@@ -211,6 +459,5 @@ if __name__ == "__main__":
     try:
         main()
     except Exception as e:
-        import traceback
         print("❌ Fatal error:", e)
         traceback.print_exc()